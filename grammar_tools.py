@@ -1,11 +1,44 @@
-from datetime import datetime
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import List, Dict, Any
 from mcp_server import mcp
 from utils import (
     notion_client,
     GRAMMAR_DATABASE_ID,
-    _get_notion_property
+    GRAMMAR_SCHEMA,
+    _get_notion_property,
+    _read_page,
+    cache_updated_page,
+    cached_query,
+    gather_bounded,
+    invalidate_cache
 )
 
+def _grammar_properties(
+    concept_name: str,
+    category: str,
+    difficulty_level: str,
+    description: str,
+    examples: str,
+    practice_notes: str = None,
+    date_added: str = None
+) -> dict:
+    """Build the Notion properties payload for a new grammar concept."""
+    properties = {
+        "Concept Name": {"title": [{"text": {"content": concept_name}}]},
+        "Category": {"select": {"name": category}},
+        "Difficulty Level": {"select": {"name": difficulty_level}},
+        "Description": {"rich_text": [{"text": {"content": description}}]},
+        "Examples": {"rich_text": [{"text": {"content": examples}}]},
+        "Date Added": {"date": {"start": date_added or datetime.now(timezone.utc).isoformat()}},
+        "Mastery Status": {"select": {"name": "Learning"}},
+    }
+    
+    if practice_notes:
+        properties["Practice Notes"] = {"rich_text": [{"text": {"content": practice_notes}}]}
+    
+    return properties
+
 @mcp.tool()
 async def add_grammar_concept(
     concept_name: str,
@@ -20,28 +53,55 @@ async def add_grammar_concept(
         return "Error: Notion client not initialized"
     
     try:
-        properties = {
-            "Concept Name": {"title": [{"text": {"content": concept_name}}]},
-            "Category": {"select": {"name": category}},
-            "Difficulty Level": {"select": {"name": difficulty_level}},
-            "Description": {"rich_text": [{"text": {"content": description}}]},
-            "Examples": {"rich_text": [{"text": {"content": examples}}]},
-            "Date Added": {"date": {"start": datetime.now().isoformat()}},
-            "Mastery Status": {"select": {"name": "Learning"}},
-        }
-        
-        if practice_notes:
-            properties["Practice Notes"] = {"rich_text": [{"text": {"content": practice_notes}}]}
+        properties = _grammar_properties(
+            concept_name, category, difficulty_level, description, examples, practice_notes
+        )
         
-        result = notion_client.pages.create(
+        result = await notion_client.pages.create(
             parent={"database_id": GRAMMAR_DATABASE_ID},
             properties=properties
         )
+        invalidate_cache(GRAMMAR_DATABASE_ID)
         
         return f"Successfully added grammar concept '{concept_name}'. ID: {result['id']}"
     except Exception as e:
         return f"Error adding grammar concept: {str(e)}"
 
+@mcp.tool()
+async def bulk_add_grammar_concepts(concepts: List[Dict[str, Any]]) -> str:
+    """Add several grammar concepts at once.
+
+    Each item takes the same fields as add_grammar_concept.
+    """
+    if not notion_client:
+        return "Error: Notion client not initialized"
+    
+    date_added = datetime.now(timezone.utc).isoformat()
+    
+    async def _create(concept: Dict[str, Any]) -> dict:
+        return await notion_client.pages.create(
+            parent={"database_id": GRAMMAR_DATABASE_ID},
+            properties=_grammar_properties(**concept, date_added=date_added)
+        )
+    
+    results = await gather_bounded((_create(concept) for concept in concepts), limit=4, return_exceptions=True)
+    invalidate_cache(GRAMMAR_DATABASE_ID)
+    
+    failed = [
+        (concept.get('concept_name', f"#{index + 1}"), result)
+        for index, (concept, result) in enumerate(zip(concepts, results))
+        if isinstance(result, Exception)
+    ]
+    
+    parts = [f"Added {len(concepts) - len(failed)}/{len(concepts)} grammar concepts.\n"]
+    
+    if failed:
+        parts.append(f"\n**Failed to add ({len(failed)}):**\n")
+        for name, error in failed:
+            parts.append(f"- {name}: {error}\n")
+    
+    return "".join(parts)
+
 @mcp.tool()
 async def get_grammar_concepts(
     category: str = None,
@@ -74,7 +134,7 @@ async def get_grammar_concepts(
                 "select": {"equals": mastery_status}
             })
         
-        query_params = {"database_id": GRAMMAR_DATABASE_ID}
+        query_params = {}
         
         if filter_conditions:
             if len(filter_conditions) == 1:
@@ -84,44 +144,35 @@ async def get_grammar_concepts(
                     "and": filter_conditions
                 }
         
-        response = notion_client.databases.query(**query_params)
-        
         concepts = []
-        for page in response["results"]:
-            concept_name = _get_notion_property(page, "Concept Name", "title")
-            category_val = _get_notion_property(page, "Category", "select")
-            difficulty_val = _get_notion_property(page, "Difficulty Level", "select")
-            mastery_val = _get_notion_property(page, "Mastery Status", "select")
+        for page in await cached_query(GRAMMAR_DATABASE_ID, **query_params):
+            row = _read_page(page, GRAMMAR_SCHEMA)
             
             concepts.append({
                 "id": page["id"],
-                "concept_name": concept_name,
-                "category": category_val,
-                "difficulty_level": difficulty_val,
-                "mastery_status": mastery_val
+                "concept_name": row["Concept Name"],
+                "category": row["Category"],
+                "difficulty_level": row["Difficulty Level"],
+                "mastery_status": row["Mastery Status"]
             })
         
         if not concepts:
             return "No grammar concepts found matching the criteria."
         
-        response_text = f"Found {len(concepts)} grammar concepts:\n\n"
+        parts = [f"Found {len(concepts)} grammar concepts:\n\n"]
         
         # Group by category
-        by_category = {}
+        by_category = defaultdict(list)
         for concept in concepts:
-            cat = concept.get('category', 'Uncategorized')
-            if cat not in by_category:
-                by_category[cat] = []
-            by_category[cat].append(concept)
+            by_category[concept['category'] or 'Uncategorized'].append(concept)
         
-        for category_name, items in by_category.items():
-            response_text += f"**{category_name}:**\n"
+        for category_name, items in sorted(by_category.items()):
+            parts.append(f"**{category_name}:**\n")
             for concept in items:
-                response_text += f"- {concept['concept_name']} "
-                response_text += f"({concept['difficulty_level']}, {concept['mastery_status']})\n"
-            response_text += "\n"
+                parts.append(f"- {concept['concept_name']} ({concept['difficulty_level']}, {concept['mastery_status']})\n")
+            parts.append("\n")
         
-        return response_text
+        return "".join(parts)
     except Exception as e:
         return f"Error getting grammar concepts: {str(e)}"
 
@@ -136,10 +187,6 @@ async def update_grammar_mastery(
         return "Error: Notion client not initialized"
     
     try:
-        # Get current concept data
-        page = notion_client.pages.retrieve(concept_id)
-        concept_name = _get_notion_property(page, "Concept Name", "title")
-        
         update_properties = {
             "Mastery Status": {"select": {"name": mastery_status}}
         }
@@ -149,10 +196,13 @@ async def update_grammar_mastery(
             update_properties["Practice Notes"] = {"rich_text": [{"text": {"content": practice_notes}}]}
             notes_updated = True
         
-        notion_client.pages.update(
+        # The update response is the full updated page, so no separate retrieve is needed
+        page = await notion_client.pages.update(
             page_id=concept_id,
             properties=update_properties
         )
+        concept_name = _get_notion_property(page, "Concept Name", "title")
+        cache_updated_page(page, GRAMMAR_DATABASE_ID)
         
         response = f"Updated grammar concept '{concept_name}':\n"
         response += f"- New mastery status: {mastery_status}\n"
@@ -164,50 +214,50 @@ async def update_grammar_mastery(
         return f"Error updating grammar mastery: {str(e)}"
 
 @mcp.tool()
-async def search_grammar(query: str) -> str:
-    """Search grammar concepts by name, category, or content."""
+async def search_grammar(query: str, limit: int = 50) -> str:
+    """Search grammar concepts by name, category, or content, returning at most `limit` matches."""
     if not notion_client:
         return "Error: Notion client not initialized"
     
     try:
-        response = notion_client.databases.query(database_id=GRAMMAR_DATABASE_ID)
+        # Let Notion do the matching instead of scanning every concept here
+        pages = await cached_query(
+            GRAMMAR_DATABASE_ID,
+            limit=limit,
+            filter={
+                "or": [
+                    {"property": "Concept Name", "title": {"contains": query}},
+                    {"property": "Category", "select": {"equals": query}},
+                    {"property": "Description", "rich_text": {"contains": query}},
+                    {"property": "Examples", "rich_text": {"contains": query}}
+                ]
+            }
+        )
         
         results = []
-        query_lower = query.lower()
-        
-        for page in response["results"]:
-            concept_name = _get_notion_property(page, "Concept Name", "title") or ""
-            category = _get_notion_property(page, "Category", "select") or ""
-            description = _get_notion_property(page, "Description") or ""
-            examples = _get_notion_property(page, "Examples") or ""
-            difficulty_level = _get_notion_property(page, "Difficulty Level", "select")
-            mastery_status = _get_notion_property(page, "Mastery Status", "select")
-            
-            # Search in concept name, category, description, and examples
-            if (query_lower in concept_name.lower() or 
-                query_lower in category.lower() or 
-                query_lower in description.lower() or
-                query_lower in examples.lower()):
-                results.append({
-                    "concept_name": concept_name,
-                    "category": category,
-                    "description": description,
-                    "difficulty_level": difficulty_level,
-                    "mastery_status": mastery_status
-                })
+        for page in pages:
+            row = _read_page(page, GRAMMAR_SCHEMA)
+            results.append({
+                "concept_name": row["Concept Name"],
+                "category": row["Category"],
+                "description": row["Description"],
+                "difficulty_level": row["Difficulty Level"],
+                "mastery_status": row["Mastery Status"]
+            })
         
         if not results:
             return f"No grammar concepts found matching '{query}'"
         
-        response_text = f"Found {len(results)} grammar concepts:\n\n"
+        parts = [f"Found {len(results)} grammar concepts:\n\n"]
         for concept in results:
-            response_text += f"**{concept['concept_name']}**\n"
-            response_text += f"- Category: {concept['category']}\n"
-            response_text += f"- Difficulty: {concept['difficulty_level']}\n"
-            response_text += f"- Mastery: {concept['mastery_status']}\n"
-            description_preview = concept['description'][:100] + "..." if len(concept['description']) > 100 else concept['description']
-            response_text += f"- Description: {description_preview}\n\n"
-        
-        return response_text
+            parts.append(f"**{concept['concept_name']}**\n")
+            parts.append(f"- Category: {concept['category']}\n")
+            parts.append(f"- Difficulty: {concept['difficulty_level']}\n")
+            parts.append(f"- Mastery: {concept['mastery_status']}\n")
+            description = concept['description']
+            description_preview = f"{description[:100]}..." if len(description) > 100 else description
+            parts.append(f"- Description: {description_preview}\n\n")
+        
+        return "".join(parts)
     except Exception as e:
         return f"Error searching grammar: {str(e)}"
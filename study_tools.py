@@ -1,15 +1,48 @@
-from datetime import datetime
+import asyncio
+from datetime import datetime, timezone
 from typing import List, Dict, Any
 from mcp_server import mcp
 from utils import (
     notion_client,
     GRAMMAR_DATABASE_ID,
     VOCAB_DATABASE_ID,
+    GRAMMAR_SCHEMA,
+    VOCAB_SCHEMA,
     _get_notion_property,
-    calculate_new_mastery_level,
-    calculate_weighted_success_rate
+    _read_page,
+    apply_vocabulary_review,
+    cache_updated_page,
+    cached_query,
+    gather_by_key,
+    property_ids
 )
 
+async def _session_vocabulary(count: int, filter_properties: List[str]) -> list:
+    """Pick vocabulary for a session: never-reviewed words, then unmastered words reviewed longest ago."""
+    # Notion sorts empty dates last, so never-reviewed words need their own query
+    never_reviewed = await cached_query(
+        VOCAB_DATABASE_ID,
+        limit=count,
+        filter_properties=filter_properties,
+        filter={"property": "Last Reviewed", "date": {"is_empty": True}}
+    )
+    if len(never_reviewed) >= count:
+        return never_reviewed
+    
+    stale = await cached_query(
+        VOCAB_DATABASE_ID,
+        limit=count - len(never_reviewed),
+        filter_properties=filter_properties,
+        filter={
+            "and": [
+                {"property": "Last Reviewed", "date": {"is_not_empty": True}},
+                {"property": "Mastery Level", "select": {"does_not_equal": "Mastered"}}
+            ]
+        },
+        sorts=[{"property": "Last Reviewed", "direction": "ascending"}]
+    )
+    return never_reviewed + stale
+
 @mcp.tool()
 async def get_study_session_data(vocab_count: int = 10, grammar_count: int = 5) -> str:
     """Prepare a mixed study session with vocabulary and grammar."""
@@ -17,163 +50,166 @@ async def get_study_session_data(vocab_count: int = 10, grammar_count: int = 5)
         return "Error: Notion client not initialized"
     
     try:
-        # Get vocabulary for review
-        vocab_response = notion_client.databases.query(database_id=VOCAB_DATABASE_ID)
-        vocab_items = []
+        vocab_properties = await property_ids(VOCAB_DATABASE_ID, [
+            "Word/Phrase", "English Translation", "Review Count", "Success Rate"
+        ])
+        grammar_properties = await property_ids(GRAMMAR_DATABASE_ID, ["Concept Name", "Category"])
         
-        for page in vocab_response["results"]:
-            word = _get_notion_property(page, "Word/Phrase", "title")
-            translation = _get_notion_property(page, "English Translation")
-            mastery_level = _get_notion_property(page, "Mastery Level", "select")
-            last_reviewed = _get_notion_property(page, "Last Reviewed", "date")
-            
-            # Simple check for words due for review (no last_reviewed or mastery not "Mastered")
-            if not last_reviewed or mastery_level != "Mastered":
-                vocab_items.append({
-                    "id": page["id"],
-                    "word": word,
-                    "translation": translation
-                })
-        
-        # Limit vocab items
-        vocab_items = vocab_items[:vocab_count]
-        
-        # Get grammar concepts for review (focusing on "Learning" status)
-        grammar_response = notion_client.databases.query(
-            database_id=GRAMMAR_DATABASE_ID,
-            filter={
-                "property": "Mastery Status",
-                "select": {"equals": "Learning"}
-            }
+        # The vocabulary and grammar queries are independent, so run them concurrently
+        vocab_pages, grammar_pages = await asyncio.gather(
+            # Vocabulary for review (never reviewed or not yet mastered)
+            _session_vocabulary(vocab_count, vocab_properties),
+            # Grammar concepts for review (focusing on "Learning" status)
+            cached_query(
+                GRAMMAR_DATABASE_ID,
+                limit=grammar_count,
+                filter_properties=grammar_properties,
+                filter={
+                    "property": "Mastery Status",
+                    "select": {"equals": "Learning"}
+                }
+            )
         )
         
+        vocab_items = []
+        for page in vocab_pages:
+            row = _read_page(page, VOCAB_SCHEMA)
+            
+            vocab_items.append({
+                "id": page["id"],
+                "word": row["Word/Phrase"],
+                "translation": row["English Translation"],
+                "review_count": row["Review Count"] or 0,
+                "success_rate": row["Success Rate"] or 0
+            })
+        
         grammar_items = []
-        for page in grammar_response["results"]:
-            concept_name = _get_notion_property(page, "Concept Name", "title")
-            category = _get_notion_property(page, "Category", "select")
+        for page in grammar_pages:
+            row = _read_page(page, GRAMMAR_SCHEMA)
             
             grammar_items.append({
                 "id": page["id"],
-                "concept_name": concept_name,
-                "category": category
+                "concept_name": row["Concept Name"],
+                "category": row["Category"]
             })
         
-        # Limit grammar items
-        grammar_items = grammar_items[:grammar_count]
-        
-        response_text = "**Study Session Prepared**\n\n"
+        parts = ["**Study Session Prepared**\n\n"]
         
         if vocab_items:
-            response_text += f"**Vocabulary ({len(vocab_items)} words):**\n"
+            parts.append(f"**Vocabulary ({len(vocab_items)} words):**\n")
             for item in vocab_items:
-                response_text += f"- {item['word']} - {item['translation']}\n"
-            response_text += "\n"
+                parts.append(f"- {item['word']} - {item['translation']} ")
+                parts.append(f"(ID: {item['id']}, review_count: {item['review_count']}, success_rate: {item['success_rate']})\n")
+            parts.append("\n")
         
         if grammar_items:
-            response_text += f"**Grammar ({len(grammar_items)} concepts):**\n"
+            parts.append(f"**Grammar ({len(grammar_items)} concepts):**\n")
             for item in grammar_items:
-                response_text += f"- {item['concept_name']} ({item['category']})\n"
-            response_text += "\n"
+                parts.append(f"- {item['concept_name']} ({item['category']}, ID: {item['id']})\n")
+            parts.append("\n")
         
         total_items = len(vocab_items) + len(grammar_items)
-        response_text += f"Total items for review: {total_items}"
+        parts.append(f"Total items for review: {total_items}")
         
-        return response_text
+        return "".join(parts)
     except Exception as e:
         return f"Error preparing study session: {str(e)}"
 
+async def _process_result(result: Dict[str, Any], reviewed_at: str) -> tuple[str, Dict[str, Any]] | None:
+    """Apply a single study result to Notion and return its update record."""
+    result_type = result.get('type')
+    result_id = result.get('id')
+    
+    if result_type == 'vocabulary':
+        # Update vocabulary mastery, reusing the stats from get_study_session_data
+        # when the caller passes them back
+        update = await apply_vocabulary_review(
+            result_id,
+            result.get('correct', 0),
+            result.get('total', 1),
+            reviewed_at,
+            review_count=result.get('review_count'),
+            success_rate=result.get('success_rate')
+        )
+        return result_type, update
+        
+    elif result_type == 'grammar':
+        # Update grammar mastery
+        new_mastery = result.get('new_mastery', 'Learning')
+        notes = result.get('notes')
+        
+        update_properties = {
+            "Mastery Status": {"select": {"name": new_mastery}}
+        }
+        
+        if notes:
+            update_properties["Practice Notes"] = {"rich_text": [{"text": {"content": notes}}]}
+        
+        # The update response carries the concept name, so skip the retrieve
+        page = await notion_client.pages.update(
+            page_id=result_id,
+            properties=update_properties
+        )
+        concept_name = _get_notion_property(page, "Concept Name", "title")
+        cache_updated_page(page, GRAMMAR_DATABASE_ID)
+        
+        return result_type, {
+            "concept_name": concept_name,
+            "new_mastery_status": new_mastery
+        }
+    
+    return None
+
 @mcp.tool()
 async def update_study_progress(results: List[Dict[str, Any]]) -> str:
-    """Update progress after completing a study session."""
+    """Update progress after completing a study session.
+
+    Vocabulary results may include the review_count and success_rate shown by
+    get_study_session_data, which saves re-reading each word from Notion unless
+    the database tracks Correct Count / Attempt Count.
+    """
     if not notion_client:
         return "Error: Notion client not initialized"
     
     try:
-        vocab_updates = []
-        grammar_updates = []
+        # One timestamp for the whole session, so every word shares the same review time
+        reviewed_at = datetime.now(timezone.utc).isoformat()
         
-        for result in results:
-            result_type = result.get('type')
-            result_id = result.get('id')
-            
-            if result_type == 'vocabulary':
-                # Update vocabulary mastery
-                correct = result.get('correct', 0)
-                total = result.get('total', 1)
-                
-                # Get current word data
-                page = notion_client.pages.retrieve(result_id)
-                word = _get_notion_property(page, "Word/Phrase", "title")
-                current_review_count = _get_notion_property(page, "Review Count", "number") or 0
-                current_success_rate = _get_notion_property(page, "Success Rate", "number") or 0
-                
-                # Calculate new success rate
-                session_success_rate = (correct / total) * 100 if total > 0 else 0
-                new_review_count = current_review_count + 1
-                
-                # Weighted average of success rates
-                new_success_rate = calculate_weighted_success_rate(current_success_rate, current_review_count, session_success_rate)
-                
-                # Determine new mastery level
-                new_mastery_level = calculate_new_mastery_level(new_success_rate, new_review_count)
-                
-                # Update the page
-                notion_client.pages.update(
-                    page_id=result_id,
-                    properties={
-                        "Mastery Level": {"select": {"name": new_mastery_level}},
-                        "Review Count": {"number": new_review_count},
-                        "Success Rate": {"number": round(new_success_rate, 1)},
-                        "Last Reviewed": {"date": {"start": datetime.now().isoformat()}}
-                    }
-                )
-                
-                vocab_updates.append({
-                    "word": word,
-                    "new_mastery_level": new_mastery_level,
-                    "new_success_rate": round(new_success_rate, 1)
-                })
-                
-            elif result_type == 'grammar':
-                # Update grammar mastery
-                new_mastery = result.get('new_mastery', 'Learning')
-                notes = result.get('notes')
-                
-                # Get current concept data
-                page = notion_client.pages.retrieve(result_id)
-                concept_name = _get_notion_property(page, "Concept Name", "title")
-                
-                update_properties = {
-                    "Mastery Status": {"select": {"name": new_mastery}}
-                }
-                
-                if notes:
-                    update_properties["Practice Notes"] = {"rich_text": [{"text": {"content": notes}}]}
-                
-                notion_client.pages.update(
-                    page_id=result_id,
-                    properties=update_properties
-                )
-                
-                grammar_updates.append({
-                    "concept_name": concept_name,
-                    "new_mastery_status": new_mastery
-                })
-        
-        response_text = "**Study Session Progress Updated**\n\n"
+        # Repeated ids are applied in order, so each update builds on the previous one
+        processed = await gather_by_key(
+            results,
+            key=lambda result: result.get('id'),
+            apply=lambda result: _process_result(result, reviewed_at)
+        )
+        
+        failed = [
+            (result.get('id'), outcome)
+            for result, outcome in zip(results, processed)
+            if isinstance(outcome, Exception)
+        ]
+        succeeded = [outcome for outcome in processed if outcome and not isinstance(outcome, Exception)]
+        vocab_updates = [update for kind, update in succeeded if kind == 'vocabulary']
+        grammar_updates = [update for kind, update in succeeded if kind == 'grammar']
+        
+        parts = ["**Study Session Progress Updated**\n\n"]
         
         if vocab_updates:
-            response_text += f"**Vocabulary ({len(vocab_updates)} words updated):**\n"
+            parts.append(f"**Vocabulary ({len(vocab_updates)} words updated):**\n")
             for update in vocab_updates:
-                response_text += f"- {update['word']}: {update['new_mastery_level']} "
-                response_text += f"({update['new_success_rate']}%)\n"
-            response_text += "\n"
+                parts.append(f"- {update['word']}: {update['mastery_level']} ({update['success_rate']}%)\n")
+            parts.append("\n")
         
         if grammar_updates:
-            response_text += f"**Grammar ({len(grammar_updates)} concepts updated):**\n"
+            parts.append(f"**Grammar ({len(grammar_updates)} concepts updated):**\n")
             for update in grammar_updates:
-                response_text += f"- {update['concept_name']}: {update['new_mastery_status']}\n"
+                parts.append(f"- {update['concept_name']}: {update['new_mastery_status']}\n")
+            parts.append("\n")
+        
+        if failed:
+            parts.append(f"**Failed to update ({len(failed)}):**\n")
+            for result_id, error in failed:
+                parts.append(f"- ID: {result_id} - {error}\n")
         
-        return response_text
+        return "".join(parts)
     except Exception as e:
         return f"Error updating study progress: {str(e)}"
@@ -1,7 +1,12 @@
+import asyncio
+import json
 import os
-from datetime import datetime
-from typing import Any
-from notion_client import Client as NotionClient
+import time
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable
+import httpx
+from notion_client import AsyncClient
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -10,72 +15,392 @@ NOTION_TOKEN = os.getenv("NOTION_TOKEN")
 VOCAB_DATABASE_ID = os.getenv("VOCAB_DATABASE_ID")
 GRAMMAR_DATABASE_ID = os.getenv("GRAMMAR_DATABASE_ID")
 
-# Initialize Notion client
-notion_client = NotionClient(auth=NOTION_TOKEN) if NOTION_TOKEN else None
+# Notion allows an average of three requests per second per integration
+NOTION_REQUEST_INTERVAL = 0.34
+_next_request_at = 0.0
+
+async def _pace_request(request: httpx.Request) -> None:
+    """Delay an outgoing request until its slot in the Notion rate limit."""
+    global _next_request_at
+    now = time.monotonic()
+    slot = max(now, _next_request_at)
+    _next_request_at = slot + NOTION_REQUEST_INTERVAL
+    if slot > now:
+        await asyncio.sleep(slot - now)
+
+# One pooled HTTP/2 session shared by every Notion call, so concurrent bursts are
+# multiplexed over kept-alive connections instead of opening new ones. Every request
+# is paced through _pace_request, so bursts queue locally instead of being rejected with 429s.
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=40, keepalive_expiry=60),
+    event_hooks={"request": [_pace_request]},
+)
+
+# Initialize Notion client (async, so tools don't block the event loop on HTTP calls)
+notion_client = (
+    AsyncClient(auth=NOTION_TOKEN, timeout_ms=30_000, client=http_client)
+    if NOTION_TOKEN else None
+)
+
+# Property types for each database, used with _read_page
+VOCAB_SCHEMA = {
+    "Word/Phrase": "title",
+    "English Translation": "rich_text",
+    "Part of Speech": "select",
+    "Definition": "rich_text",
+    "Example Sentence": "rich_text",
+    "Example Translation": "rich_text",
+    "Date Added": "date",
+    "Mastery Level": "select",
+    "Difficulty": "select",
+    "Last Reviewed": "date",
+    "Review Count": "number",
+    "Success Rate": "number",
+    "Source Text": "rich_text",
+}
+GRAMMAR_SCHEMA = {
+    "Concept Name": "title",
+    "Category": "select",
+    "Difficulty Level": "select",
+    "Mastery Status": "select",
+    "Description": "rich_text",
+    "Examples": "rich_text",
+    "Date Added": "date",
+    "Practice Notes": "rich_text",
+}
+
+# Short-lived caches of Notion reads: page ID -> page, (database ID, query) -> pages
+PAGE_CACHE_TTL = 60
+QUERY_CACHE_TTL = 30
+# Refetch database schemas periodically, so properties added while the server runs are seen
+SCHEMA_CACHE_TTL = 60
+CACHE_MAX_ENTRIES = 512
+_page_cache: dict[str, tuple[float, dict]] = {}
+_query_cache: dict[tuple[str, str], tuple[float, list]] = {}
+
+# Property name -> property ID for each database, fetched on first use and
+# refreshed after SCHEMA_CACHE_TTL
+_property_ids: dict[str, tuple[float, dict[str, str]]] = {}
 
 def _extract_rich_text(rich_text: list) -> str:
     """Extract plain text from Notion's rich text objects."""
-    return "".join(text_obj.get("plain_text", "") for text_obj in rich_text)
+    # Most values are a single text fragment, so skip the join in that case
+    if len(rich_text) == 1:
+        return rich_text[0].get("plain_text", "")
+    return "".join([text_obj.get("plain_text", "") for text_obj in rich_text])
 
-def _get_notion_property(page: dict, prop_name: str, prop_type: str = "rich_text") -> Any:
-    """Extract property value from Notion page."""
+# Value readers for each Notion property type, used by _read_page
+_READERS = {
+    "title": lambda prop: _extract_rich_text(prop.get("title", [])),
+    "rich_text": lambda prop: _extract_rich_text(prop.get("rich_text", [])),
+    "select": lambda prop: (prop.get("select") or {}).get("name"),
+    "number": lambda prop: prop.get("number"),
+    "date": lambda prop: (prop.get("date") or {}).get("start"),
+}
+
+def _read_page(page: dict, schema: dict[str, str]) -> dict[str, Any]:
+    """Read several properties from a Notion page, given a name-to-type schema."""
+    props = page.get("properties", {})
+    return {name: _READERS[prop_type](props.get(name, {})) for name, prop_type in schema.items()}
+
+async def property_ids(database_id: str, names: Iterable[str]) -> list[str]:
+    """Look up property IDs by name for a query's `filter_properties`, skipping unknown names."""
+    ids = _cache_get(_property_ids, database_id, SCHEMA_CACHE_TTL)
+    if ids is None:
+        database = await notion_client.databases.retrieve(database_id)
+        ids = {name: prop["id"] for name, prop in database["properties"].items()}
+        _cache_set(_property_ids, database_id, ids)
+    
+    return [ids[name] for name in names if name in ids]
+
+async def _query_all(database_id: str, limit: int = None, **kwargs) -> AsyncIterator[dict]:
+    """Yield pages from a database query, prefetching the next page and stopping after `limit`."""
+    if limit is not None:
+        if limit <= 0:
+            return
+        kwargs.setdefault("page_size", min(limit, 100))
+    
+    def _request(cursor: str = None) -> asyncio.Future:
+        return asyncio.ensure_future(
+            notion_client.databases.query(database_id=database_id, start_cursor=cursor, **kwargs)
+        )
+    
+    remaining = limit
+    pending = _request()
     try:
-        prop = page.get("properties", {}).get(prop_name, {})
-        
-        if prop_type == "rich_text":
-            return _extract_rich_text(prop.get("rich_text", []))
-        elif prop_type == "title":
-            return _extract_rich_text(prop.get("title", []))
-        elif prop_type == "select":
-            select_obj = prop.get("select")
-            return select_obj.get("name") if select_obj else None
-        elif prop_type == "number":
-            return prop.get("number", 0)
-        elif prop_type == "date":
-            date_obj = prop.get("date")
-            return date_obj.get("start") if date_obj else None
-        else:
-            return prop.get(prop_type)
-    except Exception:
+        while pending is not None:
+            response = await pending
+            pending = None
+            results = response.get("results", [])
+            next_cursor = response.get("next_cursor")
+            if response.get("has_more") and next_cursor and (limit is None or len(results) < remaining):
+                pending = _request(next_cursor)
+            
+            for page in results:
+                yield page
+                if limit is not None:
+                    remaining -= 1
+                    if remaining <= 0:
+                        return
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+def _slim_page(page: dict) -> dict:
+    """Keep only the parts of a page the tools read, to keep cache entries small."""
+    return {"id": page["id"], "properties": page.get("properties", {})}
+
+def _cache_get(cache: dict, key: Any, ttl: float) -> Any:
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    
+    stored_at, value = entry
+    if time.monotonic() - stored_at > ttl:
+        del cache[key]
         return None
+    return value
+
+def _cache_set(cache: dict, key: Any, value: Any) -> None:
+    cache.pop(key, None)
+    cache[key] = (time.monotonic(), value)
+    # Evict the oldest entries once the cache is full
+    while len(cache) > CACHE_MAX_ENTRIES:
+        del cache[next(iter(cache))]
+
+async def cached_retrieve(page_id: str, ttl: float = PAGE_CACHE_TTL) -> dict:
+    """Retrieve a page, reusing a recent result if one is cached."""
+    page = _cache_get(_page_cache, page_id, ttl)
+    if page is None:
+        page = _slim_page(await notion_client.pages.retrieve(page_id))
+        _cache_set(_page_cache, page_id, page)
+    return page
+
+async def cached_query(database_id: str, ttl: float = QUERY_CACHE_TTL, limit: int = None, **kwargs) -> list[dict]:
+    """Run a paginated database query, reusing a recent result for identical queries."""
+    key = (database_id, json.dumps({"limit": limit, **kwargs}, sort_keys=True))
+    pages = _cache_get(_query_cache, key, ttl)
+    if pages is None:
+        pages = [_slim_page(page) async for page in _query_all(database_id, limit=limit, **kwargs)]
+        _cache_set(_query_cache, key, pages)
+    return pages
+
+def invalidate_cache(database_id: str) -> None:
+    """Drop cached query results made stale by a write to a database."""
+    for key in [key for key in _query_cache if key[0] == database_id]:
+        del _query_cache[key]
 
-def calculate_days_overdue(last_reviewed: str, mastery_level: str) -> int:
+def cache_updated_page(page: dict, database_id: str) -> None:
+    """Keep the page returned by an update cached and drop its database's cached queries."""
+    invalidate_cache(database_id)
+    _cache_set(_page_cache, page["id"], _slim_page(page))
+
+async def gather_bounded(aws: Iterable[Awaitable], limit: int = 3, return_exceptions: bool = False) -> list:
+    """Await all awaitables concurrently, in input order, with at most `limit` running at once."""
+    semaphore = asyncio.Semaphore(limit)
+    
+    async def _run(aw: Awaitable) -> Any:
+        async with semaphore:
+            return await aw
+    
+    return await asyncio.gather(*(_run(aw) for aw in aws), return_exceptions=return_exceptions)
+
+async def gather_by_key(items: list, key: Callable[[Any], Any], apply: Callable[[Any], Awaitable]) -> list:
+    """Apply `apply` to items concurrently across keys but in order within a key."""
+    indexes_by_key: dict[Any, list[int]] = {}
+    for index, item in enumerate(items):
+        indexes_by_key.setdefault(key(item), []).append(index)
+    
+    outcomes: list = [None] * len(items)
+    
+    async def _apply_in_order(indexes: list[int]) -> None:
+        for index in indexes:
+            try:
+                outcomes[index] = await apply(items[index])
+            except Exception as e:
+                outcomes[index] = e
+    
+    await gather_bounded(_apply_in_order(indexes) for indexes in indexes_by_key.values())
+    return outcomes
+
+def _get_notion_property(page: dict, prop_name: str, prop_type: str = "rich_text") -> Any:
+    """Extract property value from Notion page."""
+    prop = page.get("properties", {}).get(prop_name, {})
+    reader = _READERS.get(prop_type)
+    return reader(prop) if reader else prop.get(prop_type)
+
+# Spaced repetition intervals (in days) based on mastery
+REVIEW_INTERVALS = {
+    "New": 1,
+    "Learning": 3,
+    "Familiar": 7,
+    "Mastered": 30
+}
+
+@lru_cache(maxsize=4096)
+def _parse_iso(timestamp: str) -> datetime:
+    """Parse a Notion ISO timestamp into an aware datetime."""
+    # Python 3.11+ parses Notion's trailing 'Z' natively
+    parsed = datetime.fromisoformat(timestamp)
+    if parsed.tzinfo is None:
+        # Older entries were written without an offset; treat them as UTC
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+def calculate_days_overdue(last_reviewed: str, mastery_level: str, now: datetime = None) -> int:
     """Calculate how many days a word is overdue for review."""
     if not last_reviewed:
         return 999  # Never reviewed
     
     try:
-        last_date = datetime.fromisoformat(last_reviewed.replace('Z', '+00:00'))
-        now = datetime.now()
+        last_date = _parse_iso(last_reviewed)
+        now = now or datetime.now(timezone.utc)
         days_since = (now - last_date).days
         
-        # Spaced repetition intervals based on mastery
-        intervals = {
-            "New": 1,
-            "Learning": 3,
-            "Familiar": 7,
-            "Mastered": 30
-        }
-        
-        interval = intervals.get(mastery_level, 1)
+        interval = REVIEW_INTERVALS.get(mastery_level, 1)
         return max(0, days_since - interval)
     except Exception:
         return 0
 
+# (minimum success rate, minimum review count, level), checked in order
+_MASTERY_THRESHOLDS = (
+    (90, 5, "Mastered"),
+    (75, 3, "Familiar"),
+    (0, 1, "Learning"),
+)
+
+@lru_cache(maxsize=1024)
+def _classify_mastery(rate_bucket: int, review_count: int) -> str:
+    """Map a whole-number success rate and review count to a mastery level."""
+    for min_rate, min_count, level in _MASTERY_THRESHOLDS:
+        if rate_bucket >= min_rate and review_count >= min_count:
+            return level
+    return "New"
+
+def build_review_due_filters(now: datetime) -> list[dict]:
+    """Build Notion filters matching words that calculate_days_overdue considers due."""
+    def _reviewed_before(level_conditions: list[dict], interval: int) -> dict:
+        cutoff = (now - timedelta(days=interval + 1)).isoformat()
+        return {
+            "and": [
+                *({"property": "Mastery Level", "select": condition} for condition in level_conditions),
+                {"property": "Last Reviewed", "date": {"on_or_before": cutoff}}
+            ]
+        }
+    
+    conditions = [{"property": "Last Reviewed", "date": {"is_empty": True}}]
+    for level, interval in REVIEW_INTERVALS.items():
+        conditions.append(_reviewed_before([{"equals": level}], interval))
+    # Words with no or an unknown mastery level are scheduled like new words
+    other_levels = [{"does_not_equal": level} for level in REVIEW_INTERVALS]
+    conditions.append(_reviewed_before(other_levels, REVIEW_INTERVALS["New"]))
+    
+    return conditions
+
 def calculate_new_mastery_level(success_rate: float, review_count: int) -> str:
     """Determine new mastery level based on success rate and review count."""
-    if success_rate >= 90 and review_count >= 5:
-        return "Mastered"
-    elif success_rate >= 75 and review_count >= 3:
-        return "Familiar"
-    elif review_count >= 1:
-        return "Learning"
-    else:
-        return "New"
+    # The thresholds are whole numbers, so flooring the rate doesn't change the result
+    return _classify_mastery(int(success_rate), review_count)
 
 def calculate_weighted_success_rate(current_rate: float, current_count: int, session_rate: float) -> float:
     """Calculate weighted average of success rates."""
     if current_count > 0:
-        return ((current_rate * current_count) + session_rate) / (current_count + 1)
+        # Running-mean update; avoids the growing rate * count product
+        return current_rate + (session_rate - current_rate) / (current_count + 1)
     else:
-        return session_rate 
\ No newline at end of file
+        return session_rate 
+
+
+# Optional vocabulary properties holding raw answer tallies. When a database has
+# them, success rates are computed exactly from the totals instead of averaged.
+ANSWER_COUNT_PROPERTIES = ("Correct Count", "Attempt Count")
+
+async def tracks_answer_counts(database_id: str) -> bool:
+    """Whether a database has the optional answer-count properties."""
+    return len(await property_ids(database_id, ANSWER_COUNT_PROPERTIES)) == len(ANSWER_COUNT_PROPERTIES)
+
+def read_answer_counts(page: dict) -> tuple[int, int] | None:
+    """Read a page's (correct, attempts) tallies, or None if it doesn't have them."""
+    props = page.get("properties", {})
+    if not all(name in props for name in ANSWER_COUNT_PROPERTIES):
+        return None
+    correct_count, attempt_count = (props[name].get("number") or 0 for name in ANSWER_COUNT_PROPERTIES)
+    return correct_count, attempt_count
+
+def calculate_success_update(
+    current_rate: float,
+    current_count: int,
+    correct: int,
+    total: int,
+    session_rate: float,
+    answer_counts: tuple[int, int] | None = None
+) -> tuple[float, dict]:
+    """Calculate the new success rate, and tally properties to write when the page tracks answers."""
+    if answer_counts is not None:
+        correct_count, attempt_count = answer_counts
+        if attempt_count == 0 and current_count > 0:
+            # Seed empty tallies from the history, sizing earlier reviews like this one
+            attempt_count = current_count * max(total, 1)
+            correct_count = round(current_rate * attempt_count / 100)
+        correct_count += correct
+        attempt_count += total
+        new_rate = correct_count * 100 / attempt_count if attempt_count > 0 else 0
+        return new_rate, {
+            "Correct Count": {"number": correct_count},
+            "Attempt Count": {"number": attempt_count}
+        }
+    
+    return calculate_weighted_success_rate(current_rate, current_count, session_rate), {}
+
+async def apply_vocabulary_review(
+    word_id: str,
+    correct: int,
+    total: int,
+    reviewed_at: str,
+    review_count: int = None,
+    success_rate: float = None
+) -> dict[str, Any]:
+    """Record a study result for one word and return its updated statistics."""
+    # A freshly written page in the cache beats stats the caller read earlier
+    page = _cache_get(_page_cache, word_id, PAGE_CACHE_TTL)
+    answer_counts = None
+    has_stats = review_count is not None and success_rate is not None
+    if page is None and has_stats and not await tracks_answer_counts(VOCAB_DATABASE_ID):
+        current_review_count = review_count or 0
+        current_success_rate = success_rate or 0
+    else:
+        page = page or await cached_retrieve(word_id)
+        current_review_count = _get_notion_property(page, "Review Count", "number") or 0
+        current_success_rate = _get_notion_property(page, "Success Rate", "number") or 0
+        answer_counts = read_answer_counts(page)
+    
+    session_success_rate = (correct / total) * 100 if total > 0 else 0
+    new_review_count = current_review_count + 1
+    
+    # Exact rate from the answer tallies when the page has them, else a weighted average
+    new_success_rate, count_properties = calculate_success_update(
+        current_success_rate, current_review_count, correct, total, session_success_rate, answer_counts
+    )
+    new_mastery_level = calculate_new_mastery_level(new_success_rate, new_review_count)
+    
+    # Update the page; the response carries the word itself
+    page = await notion_client.pages.update(
+        page_id=word_id,
+        properties={
+            "Mastery Level": {"select": {"name": new_mastery_level}},
+            "Review Count": {"number": new_review_count},
+            "Success Rate": {"number": round(new_success_rate, 1)},
+            "Last Reviewed": {"date": {"start": reviewed_at}},
+            **count_properties
+        }
+    )
+    cache_updated_page(page, VOCAB_DATABASE_ID)
+    
+    return {
+        "word": _get_notion_property(page, "Word/Phrase", "title"),
+        "mastery_level": new_mastery_level,
+        "success_rate": round(new_success_rate, 1),
+        "session_success_rate": round(session_success_rate, 1),
+        "review_count": new_review_count
+    }
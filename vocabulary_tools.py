@@ -1,17 +1,47 @@
-from datetime import datetime
+import asyncio
+import re
+import time
+from datetime import datetime, timezone
 from typing import List, Dict, Any
 from mcp_server import mcp
 from utils import (
     notion_client, 
     VOCAB_DATABASE_ID,
+    VOCAB_SCHEMA,
     _get_notion_property,
+    _read_page,
+    _query_all,
+    apply_vocabulary_review,
+    build_review_due_filters,
+    cache_updated_page,
+    cached_query,
     calculate_days_overdue,
-    calculate_new_mastery_level,
-    calculate_weighted_success_rate
+    gather_bounded,
+    gather_by_key,
+    invalidate_cache,
+    property_ids
 )
 
 # Cache for storing data
 CACHE: Dict[str, Any] = {}
+VOCAB_INDEX_TTL = 60
+
+# Common Swedish words to exclude from extraction
+_COMMON_WORDS = frozenset({
+    "att", "och", "det", "är", "som", "för", "på", "med", "av", "till", "från", "har", "den", "de", "om", "var", "eller", "när", "efter", "över", "andra", "mycket", "bara", "skulle", "första", "utan", "mellan", "under", "ser", "honom", "kommer", "man", "också", "nu", "kan", "göra", "får", "ska", "här", "något", "alla", "igen", "mer", "varje", "sedan", "våra", "vara", "samt", "vid", "sådan", "dock", "men", "så", "både", "denna", "dessa", "vilka", "vilket"
+})
+_WORD_RE = re.compile(r'\b[a-zA-ZåäöÅÄÖ]+\b')
+# A word is challenging if it is long (7+ letters), contains a Swedish
+# character, or ends in a common Swedish suffix
+_CHALLENGING_RE = re.compile(r'.{7,}|[åäöÅÄÖ]|(?:tion|ning|het|dom|skap|else)$')
+
+def _vocab_index() -> Dict[str, str]:
+    """Map of lowercased word to page ID for words recently confirmed to be in the vocabulary database."""
+    entry = CACHE.get("vocab_index")
+    if entry is None or time.monotonic() - entry[0] > VOCAB_INDEX_TTL:
+        entry = (time.monotonic(), {})
+        CACHE["vocab_index"] = entry
+    return entry[1]
 
 @mcp.tool()
 async def add_vocabulary_word(
@@ -34,7 +64,7 @@ async def add_vocabulary_word(
             "English Translation": {"rich_text": [{"text": {"content": translation}}]},
             "Part of Speech": {"select": {"name": part_of_speech}},
             "Difficulty": {"select": {"name": difficulty}},
-            "Date Added": {"date": {"start": datetime.now().isoformat()}},
+            "Date Added": {"date": {"start": datetime.now(timezone.utc).isoformat()}},
             "Mastery Level": {"select": {"name": "New"}},
             "Review Count": {"number": 0},
             "Success Rate": {"number": 0},
@@ -49,10 +79,12 @@ async def add_vocabulary_word(
         if source_text:
             properties["Source Text"] = {"rich_text": [{"text": {"content": source_text}}]}
         
-        result = notion_client.pages.create(
+        result = await notion_client.pages.create(
             parent={"database_id": VOCAB_DATABASE_ID},
             properties=properties
         )
+        invalidate_cache(VOCAB_DATABASE_ID)
+        _vocab_index()[word.lower()] = result["id"]
         
         return f"Successfully added '{word}' to vocabulary database. ID: {result['id']}"
     except Exception as e:
@@ -65,30 +97,48 @@ async def get_vocabulary_for_review(limit: int = 20) -> str:
         return "Error: Notion client not initialized"
     
     try:
-        # Get all vocabulary entries
-        response = notion_client.databases.query(database_id=VOCAB_DATABASE_ID)
+        review_properties = await property_ids(VOCAB_DATABASE_ID, [
+            "Word/Phrase", "English Translation", "Mastery Level",
+            "Difficulty", "Last Reviewed", "Example Sentence"
+        ])
+        
+        # Only fetch words that are due. The cutoffs are truncated to the minute so
+        # repeat calls can reuse the cached results.
+        now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+        never_reviewed, *interval_filters = build_review_due_filters(now)
+        
+        async def _due(due_filter: dict, count: int) -> list:
+            return await cached_query(
+                VOCAB_DATABASE_ID,
+                limit=count,
+                filter_properties=review_properties,
+                filter=due_filter,
+                sorts=[{"property": "Last Reviewed", "direction": "ascending"}]
+            )
+        
+        # Never-reviewed words rank first. Overdue days only follow Last Reviewed
+        # within one review interval, so take the oldest `limit` words of each
+        # interval and rank them together below.
+        pages = await _due(never_reviewed, limit)
+        if len(pages) < limit:
+            remaining = limit - len(pages)
+            groups = await asyncio.gather(*(_due(due_filter, remaining) for due_filter in interval_filters))
+            pages = pages + [page for group in groups for page in group]
         
         words_for_review = []
-        for page in response["results"]:
-            word = _get_notion_property(page, "Word/Phrase", "title")
-            translation = _get_notion_property(page, "English Translation")
-            mastery_level = _get_notion_property(page, "Mastery Level", "select")
-            difficulty = _get_notion_property(page, "Difficulty", "select")
-            last_reviewed = _get_notion_property(page, "Last Reviewed", "date")
-            example_sentence = _get_notion_property(page, "Example Sentence")
-            
-            days_overdue = calculate_days_overdue(last_reviewed, mastery_level or "New")
+        for page in pages:
+            row = _read_page(page, VOCAB_SCHEMA)
+            mastery_level = row["Mastery Level"]
             
-            if days_overdue > 0:  # Due for review
-                words_for_review.append({
-                    "id": page["id"],
-                    "word": word,
-                    "translation": translation,
-                    "mastery_level": mastery_level,
-                    "difficulty": difficulty,
-                    "days_overdue": days_overdue,
-                    "example_sentence": example_sentence
-                })
+            words_for_review.append({
+                "id": page["id"],
+                "word": row["Word/Phrase"],
+                "translation": row["English Translation"],
+                "mastery_level": mastery_level,
+                "difficulty": row["Difficulty"],
+                "days_overdue": calculate_days_overdue(row["Last Reviewed"], mastery_level or "New", now),
+                "example_sentence": row["Example Sentence"]
+            })
         
         # Sort by days overdue (most overdue first)
         words_for_review.sort(key=lambda x: x["days_overdue"], reverse=True)
@@ -97,17 +147,17 @@ async def get_vocabulary_for_review(limit: int = 20) -> str:
         if not words_for_review:
             return "No vocabulary words are currently due for review."
         
-        response_text = f"Found {len(words_for_review)} words due for review:\n\n"
+        parts = [f"Found {len(words_for_review)} words due for review:\n\n"]
         for word_data in words_for_review:
-            response_text += f"- **{word_data['word']}** ({word_data['translation']})\n"
-            response_text += f"  - Mastery: {word_data['mastery_level']}, "
-            response_text += f"Difficulty: {word_data['difficulty']}, "
-            response_text += f"Days overdue: {word_data['days_overdue']}\n"
+            parts.append(f"- **{word_data['word']}** ({word_data['translation']})\n")
+            parts.append(f"  - Mastery: {word_data['mastery_level']}, ")
+            parts.append(f"Difficulty: {word_data['difficulty']}, ")
+            parts.append(f"Days overdue: {word_data['days_overdue']}\n")
             if word_data.get('example_sentence'):
-                response_text += f"  - Example: {word_data['example_sentence']}\n"
-            response_text += "\n"
+                parts.append(f"  - Example: {word_data['example_sentence']}\n")
+            parts.append("\n")
         
-        return response_text
+        return "".join(parts)
     except Exception as e:
         return f"Error getting vocabulary for review: {str(e)}"
 
@@ -118,110 +168,136 @@ async def update_word_mastery(word_id: str, correct_answers: int, total_answers:
         return "Error: Notion client not initialized"
     
     try:
-        # Get current word data
-        page = notion_client.pages.retrieve(word_id)
-        word = _get_notion_property(page, "Word/Phrase", "title")
-        current_review_count = _get_notion_property(page, "Review Count", "number") or 0
-        current_success_rate = _get_notion_property(page, "Success Rate", "number") or 0
-        
-        # Calculate new success rate
-        session_success_rate = (correct_answers / total_answers) * 100 if total_answers > 0 else 0
-        new_review_count = current_review_count + 1
-        
-        # Calculate weighted average success rate
-        new_success_rate = calculate_weighted_success_rate(current_success_rate, current_review_count, session_success_rate)
-        
-        # Determine new mastery level
-        new_mastery_level = calculate_new_mastery_level(new_success_rate, new_review_count)
-        
-        # Update the page
-        notion_client.pages.update(
-            page_id=word_id,
-            properties={
-                "Mastery Level": {"select": {"name": new_mastery_level}},
-                "Review Count": {"number": new_review_count},
-                "Success Rate": {"number": round(new_success_rate, 1)},
-                "Last Reviewed": {"date": {"start": datetime.now().isoformat()}}
-            }
+        update = await apply_vocabulary_review(
+            word_id, correct_answers, total_answers, datetime.now(timezone.utc).isoformat()
         )
         
-        response = f"Updated mastery for '{word}':\n"
-        response += f"- New mastery level: {new_mastery_level}\n"
-        response += f"- Overall success rate: {round(new_success_rate, 1)}%\n"
-        response += f"- Session success rate: {round(session_success_rate, 1)}%\n"
-        response += f"- Total reviews: {new_review_count}"
+        response = f"Updated mastery for '{update['word']}':\n"
+        response += f"- New mastery level: {update['mastery_level']}\n"
+        response += f"- Overall success rate: {update['success_rate']}%\n"
+        response += f"- Session success rate: {update['session_success_rate']}%\n"
+        response += f"- Total reviews: {update['review_count']}"
         
         return response
     except Exception as e:
         return f"Error updating word mastery: {str(e)}"
 
 @mcp.tool()
-async def search_vocabulary(query: str) -> str:
-    """Search vocabulary by word, translation, or content."""
+async def update_word_mastery_batch(results: List[Dict[str, Any]]) -> str:
+    """Update mastery for several words at once after a study session.
+
+    Each item needs `word_id`, `correct` and `total`.
+    """
+    if not notion_client:
+        return "Error: Notion client not initialized"
+    
+    reviewed_at = datetime.now(timezone.utc).isoformat()
+    
+    # Repeated words are applied in order, so each update builds on the previous one
+    updates = await gather_by_key(
+        results,
+        key=lambda result: result.get('word_id'),
+        apply=lambda result: apply_vocabulary_review(
+            result.get('word_id'), result.get('correct', 0), result.get('total', 1), reviewed_at
+        )
+    )
+    
+    parts = [f"Updated mastery for {sum(not isinstance(update, Exception) for update in updates)}/{len(results)} words.\n"]
+    
+    for result, update in zip(results, updates):
+        if isinstance(update, Exception):
+            parts.append(f"- ID: {result.get('word_id')} - Error: {update}\n")
+        else:
+            parts.append(
+                f"- {update['word']}: {update['mastery_level']} "
+                f"({update['success_rate']}% over {update['review_count']} reviews)\n"
+            )
+    
+    return "".join(parts)
+
+@mcp.tool()
+async def search_vocabulary(query: str, limit: int = 50) -> str:
+    """Search vocabulary by word, translation, or content, returning at most `limit` matches."""
     if not notion_client:
         return "Error: Notion client not initialized"
     
     try:
-        response = notion_client.databases.query(database_id=VOCAB_DATABASE_ID)
+        search_properties = await property_ids(VOCAB_DATABASE_ID, [
+            "Word/Phrase", "English Translation", "Definition", "Mastery Level", "Success Rate"
+        ])
+        # Let Notion do the (case-insensitive) matching instead of scanning every word here
+        pages = await cached_query(
+            VOCAB_DATABASE_ID,
+            limit=limit,
+            filter_properties=search_properties,
+            filter={
+                "or": [
+                    {"property": "Word/Phrase", "title": {"contains": query}},
+                    {"property": "English Translation", "rich_text": {"contains": query}},
+                    {"property": "Definition", "rich_text": {"contains": query}}
+                ]
+            }
+        )
         
         results = []
-        query_lower = query.lower()
-        
-        for page in response["results"]:
-            word = _get_notion_property(page, "Word/Phrase", "title") or ""
-            translation = _get_notion_property(page, "English Translation") or ""
-            definition = _get_notion_property(page, "Definition") or ""
-            mastery_level = _get_notion_property(page, "Mastery Level", "select")
-            success_rate = _get_notion_property(page, "Success Rate", "number") or 0
-            
-            # Search in word, translation, and definition
-            if (query_lower in word.lower() or 
-                query_lower in translation.lower() or 
-                query_lower in definition.lower()):
-                results.append({
-                    "word": word,
-                    "translation": translation,
-                    "definition": definition,
-                    "mastery_level": mastery_level,
-                    "success_rate": success_rate
-                })
+        for page in pages:
+            row = _read_page(page, VOCAB_SCHEMA)
+            results.append({
+                "word": row["Word/Phrase"],
+                "translation": row["English Translation"],
+                "definition": row["Definition"],
+                "mastery_level": row["Mastery Level"],
+                "success_rate": row["Success Rate"] or 0
+            })
         
         if not results:
             return f"No vocabulary entries found matching '{query}'"
         
-        response_text = f"Found {len(results)} vocabulary entries:\n\n"
+        parts = [f"Found {len(results)} vocabulary entries:\n\n"]
         for entry in results:
-            response_text += f"- **{entry['word']}** - {entry['translation']}\n"
+            parts.append(f"- **{entry['word']}** - {entry['translation']}\n")
             if entry.get('definition'):
-                response_text += f"  - Definition: {entry['definition']}\n"
-            response_text += f"  - Mastery: {entry['mastery_level']}, "
-            response_text += f"Success rate: {entry['success_rate']}%\n\n"
+                parts.append(f"  - Definition: {entry['definition']}\n")
+            parts.append(f"  - Mastery: {entry['mastery_level']}, ")
+            parts.append(f"Success rate: {entry['success_rate']}%\n\n")
         
-        return response_text
+        return "".join(parts)
     except Exception as e:
         return f"Error searching vocabulary: {str(e)}"
 
+async def _find_existing_words(words: List[str]) -> set:
+    """Return the lowercased words from `words` that already have a vocabulary entry."""
+    vocab_index = _vocab_index()
+    unknown_words = [word for word in words if word not in vocab_index]
+    
+    if unknown_words:
+        word_properties = await property_ids(VOCAB_DATABASE_ID, ["Word/Phrase"])
+        
+        # Only ask Notion about words not already known; titles are matched in the
+        # casings words are stored with, at most 100 conditions per compound filter
+        conditions = [
+            {"property": "Word/Phrase", "title": {"equals": variant}}
+            for word in unknown_words
+            for variant in dict.fromkeys((word, word.capitalize()))
+        ]
+        for start in range(0, len(conditions), 100):
+            batch_filter = {"or": conditions[start:start + 100]}
+            async for page in _query_all(VOCAB_DATABASE_ID, filter=batch_filter, filter_properties=word_properties):
+                vocab_index[_get_notion_property(page, "Word/Phrase", "title").lower()] = page["id"]
+    
+    return {word for word in words if word in vocab_index}
+
 @mcp.tool()
 async def extract_vocabulary_from_text(text: str, add_to_database: bool = False) -> str:
     """Analyze Swedish text and identify potentially challenging words."""
     # Simple heuristic: words longer than 6 characters or containing specific Swedish characters
-    import re
-    
-    # Common Swedish words to exclude from extraction
-    common_words = {
-        "att", "och", "det", "är", "som", "för", "på", "med", "av", "till", "från", "har", "den", "de", "om", "var", "eller", "när", "efter", "över", "andra", "mycket", "bara", "skulle", "första", "utan", "mellan", "under", "ser", "honom", "kommer", "man", "också", "nu", "kan", "göra", "får", "ska", "här", "något", "alla", "igen", "mer", "varje", "sedan", "våra", "vara", "samt", "vid", "sådan", "dock", "men", "så", "både", "denna", "dessa", "vilka", "vilket"
-    }
-    
     # Find words (excluding punctuation)
-    words = re.findall(r'\b[a-zA-ZåäöÅÄÖ]+\b', text.lower())
+    words = _WORD_RE.findall(text.lower())
     
-    challenging_words = []
-    for word in set(words):  # Remove duplicates
-        if (len(word) > 6 or  # Long words
-            any(char in word for char in 'åäöÅÄÖ') or  # Contains Swedish characters
-            word.endswith(('tion', 'ning', 'het', 'dom', 'skap', 'else'))  # Common Swedish suffixes
-           ) and word not in common_words:
-            challenging_words.append(word)
+    challenging_words = [
+        word for word in set(words)  # Remove duplicates
+        if word not in _COMMON_WORDS and _CHALLENGING_RE.search(word)
+    ]
     
     if not challenging_words:
         return "No challenging words identified in the text."
@@ -232,21 +308,17 @@ async def extract_vocabulary_from_text(text: str, add_to_database: bool = False)
     if add_to_database and notion_client:
         # Check which words are already in database
         try:
-            db_response = notion_client.databases.query(database_id=VOCAB_DATABASE_ID)
-            existing_words = {_get_notion_property(page, "Word/Phrase", "title").lower() 
-                            for page in db_response["results"]}
+            existing_words = await _find_existing_words(challenging_words)
+            already_in_db = [word for word in challenging_words if word in existing_words]
+            new_words = [word for word in challenging_words if word not in existing_words]
             
-            for word in challenging_words:
-                if word in existing_words:
-                    already_in_db.append(word)
-                else:
-                    # Add to database with placeholder translation
-                    await add_vocabulary_word(
-                        word=word,
-                        translation="[Translation needed]",
-                        source_text=text[:100] + "..." if len(text) > 100 else text
-                    )
-                    results.append(word)
+            # Add new words concurrently, with a placeholder translation
+            source_text = text[:100] + "..." if len(text) > 100 else text
+            await gather_bounded(
+                add_vocabulary_word(word=word, translation="[Translation needed]", source_text=source_text)
+                for word in new_words
+            )
+            results = new_words
         except Exception as e:
             return f"Error processing words: {str(e)}"
     else:
@@ -263,6 +335,38 @@ async def extract_vocabulary_from_text(text: str, add_to_database: bool = False)
     
     return response
 
+def _format_word_details(page: dict) -> str:
+    """Render every field of a vocabulary page as markdown."""
+    row = _read_page(page, VOCAB_SCHEMA)
+    
+    parts = [f"**{row['Word/Phrase']}**\n\n"]
+    parts.append(f"- **Translation:** {row['English Translation']}\n")
+    parts.append(f"- **Part of Speech:** {row['Part of Speech']}\n")
+    
+    if row["Definition"]:
+        parts.append(f"- **Definition:** {row['Definition']}\n")
+    
+    parts.append(f"- **Difficulty:** {row['Difficulty']}\n")
+    parts.append(f"- **Mastery Level:** {row['Mastery Level']}\n")
+    
+    if row["Example Sentence"]:
+        parts.append(f"\n**Example:**\n")
+        parts.append(f"- Swedish: {row['Example Sentence']}\n")
+        if row["Example Translation"]:
+            parts.append(f"- English: {row['Example Translation']}\n")
+    
+    parts.append(f"\n**Statistics:**\n")
+    parts.append(f"- Review Count: {row['Review Count'] or 0}\n")
+    parts.append(f"- Success Rate: {row['Success Rate'] or 0}%\n")
+    
+    if row["Last Reviewed"]:
+        parts.append(f"- Last Reviewed: {row['Last Reviewed']}\n")
+    
+    if row["Source Text"]:
+        parts.append(f"\n**Source:** {row['Source Text']}\n")
+    
+    return "".join(parts)
+
 @mcp.tool()
 async def get_word_details(word_id: str) -> str:
     """Get full details for a specific vocabulary entry."""
@@ -270,87 +374,71 @@ async def get_word_details(word_id: str) -> str:
         return "Error: Notion client not initialized"
     
     try:
-        page = notion_client.pages.retrieve(word_id)
-        
-        word = _get_notion_property(page, "Word/Phrase", "title")
-        translation = _get_notion_property(page, "English Translation")
-        part_of_speech = _get_notion_property(page, "Part of Speech", "select")
-        definition = _get_notion_property(page, "Definition")
-        difficulty = _get_notion_property(page, "Difficulty", "select")
-        mastery_level = _get_notion_property(page, "Mastery Level", "select")
-        example_sentence = _get_notion_property(page, "Example Sentence")
-        example_translation = _get_notion_property(page, "Example Translation")
-        review_count = _get_notion_property(page, "Review Count", "number")
-        success_rate = _get_notion_property(page, "Success Rate", "number")
-        last_reviewed = _get_notion_property(page, "Last Reviewed", "date")
-        source_text = _get_notion_property(page, "Source Text")
-        
-        response = f"**{word}**\n\n"
-        response += f"- **Translation:** {translation}\n"
-        response += f"- **Part of Speech:** {part_of_speech}\n"
-        
-        if definition:
-            response += f"- **Definition:** {definition}\n"
-        
-        response += f"- **Difficulty:** {difficulty}\n"
-        response += f"- **Mastery Level:** {mastery_level}\n"
-        
-        if example_sentence:
-            response += f"\n**Example:**\n"
-            response += f"- Swedish: {example_sentence}\n"
-            if example_translation:
-                response += f"- English: {example_translation}\n"
-        
-        response += f"\n**Statistics:**\n"
-        response += f"- Review Count: {review_count or 0}\n"
-        response += f"- Success Rate: {success_rate or 0}%\n"
-        
-        if last_reviewed:
-            response += f"- Last Reviewed: {last_reviewed}\n"
-        
-        if source_text:
-            response += f"\n**Source:** {source_text}\n"
-        
-        return response
+        page = await notion_client.pages.retrieve(word_id)
+        return _format_word_details(page)
     except Exception as e:
         return f"Error getting word details: {str(e)}"
 
+@mcp.tool()
+async def get_word_details_batch(word_ids: List[str]) -> str:
+    """Get full details for several vocabulary entries at once."""
+    if not notion_client:
+        return "Error: Notion client not initialized"
+    
+    # Fetch entries concurrently; a missing word doesn't fail the batch
+    pages = await gather_bounded(
+        (notion_client.pages.retrieve(word_id) for word_id in word_ids),
+        return_exceptions=True
+    )
+    
+    sections = []
+    for word_id, page in zip(word_ids, pages):
+        if isinstance(page, Exception):
+            sections.append(f"Error getting details for ID {word_id}: {str(page)}\n")
+        else:
+            sections.append(_format_word_details(page))
+    
+    return "\n---\n\n".join(sections)
+
 @mcp.tool()
 async def mark_words_for_review(word_ids: List[str]) -> str:
     """Mark multiple words for immediate review by resetting their last reviewed date."""
     if not notion_client:
         return "Error: Notion client not initialized"
     
+    async def _mark(word_id: str) -> str:
+        # Reset last reviewed to force review; the updated page carries the word
+        page = await notion_client.pages.update(
+            page_id=word_id,
+            properties={
+                "Last Reviewed": {"date": None}
+            }
+        )
+        cache_updated_page(page, VOCAB_DATABASE_ID)
+        
+        return _get_notion_property(page, "Word/Phrase", "title")
+    
+    # Mark words concurrently; a missing word doesn't fail the batch
+    results = await gather_bounded((_mark(word_id) for word_id in word_ids), return_exceptions=True)
+    
     updated = []
     failed = []
+    for word_id, result in zip(word_ids, results):
+        if isinstance(result, Exception):
+            failed.append({"id": word_id, "error": str(result)})
+        else:
+            updated.append(result)
     
-    for word_id in word_ids:
-        try:
-            page = notion_client.pages.retrieve(word_id)
-            word = _get_notion_property(page, "Word/Phrase", "title")
-            
-            # Reset last reviewed to force review
-            notion_client.pages.update(
-                page_id=word_id,
-                properties={
-                    "Last Reviewed": {"date": None}
-                }
-            )
-            
-            updated.append(word)
-        except Exception as e:
-            failed.append({"id": word_id, "error": str(e)})
-    
-    response = f"Marked {len(updated)} words for review.\n"
+    parts = [f"Marked {len(updated)} words for review.\n"]
     
     if updated:
-        response += "\n**Successfully updated:**\n"
+        parts.append("\n**Successfully updated:**\n")
         for word in updated:
-            response += f"- {word}\n"
+            parts.append(f"- {word}\n")
     
     if failed:
-        response += "\n**Failed to update:**\n"
+        parts.append("\n**Failed to update:**\n")
         for failure in failed:
-            response += f"- ID: {failure['id']} - {failure['error']}\n"
+            parts.append(f"- ID: {failure['id']} - {failure['error']}\n")
     
-    return response
+    return "".join(parts)